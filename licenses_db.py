@@ -1,23 +1,42 @@
+import base64
+import inspect
 import os
 import secrets
-import string
+import shlex
+import ssl
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Dict  # NEW: for type hint of scan_licenses_and_notify return
+from itertools import islice
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
 
 import json               # NEW: for JSON encoding in webhook helper
-import urllib.request     # NEW: for sending HTTP POST without extra dependencies
-import urllib.error       # NEW: to catch HTTP errors
+import http.client        # keep-alive HTTP POSTs without extra dependencies
 
+import asyncpg
 from sqlalchemy import (
     Boolean,
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     String,
     UniqueConstraint,
     create_engine,
+    exists,
+    func,
+    literal,
+    or_,
+    select,
+    tuple_,
+    update,
 )
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker, Session, relationship
 
 # Database URL comes from Render environment
@@ -25,18 +44,145 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL is not set")
 
+
+# libpq sslmode values; asyncpg's `ssl` connect argument accepts the same strings
+_SSLMODES = frozenset({"disable", "allow", "prefer", "require", "verify-ca", "verify-full"})
+# URL options SQLAlchemy's asyncpg adapter consumes itself (never passed to asyncpg)
+_ASYNCPG_ADAPTER_ARGS = frozenset(
+    {"prepared_statement_cache_size", "prepared_statement_name_func", "async_creator_fn"}
+)
+# Query options asyncpg.connect() accepts as-is
+_ASYNCPG_URL_ARGS = (
+    frozenset(inspect.signature(asyncpg.connect).parameters) | _ASYNCPG_ADAPTER_ARGS
+)
+
+
+def _libpq_options(options: str) -> Dict[str, str]:
+    """
+    libpq's ?options=-c key=value ... -> {"key": "value"} for asyncpg's server_settings.
+    """
+    settings: Dict[str, str] = {}
+    args = shlex.split(options)
+    for i, arg in enumerate(args):
+        if arg == "-c" and i + 1 < len(args):
+            arg = args[i + 1]
+        elif arg.startswith("-c"):
+            arg = arg[2:]
+        elif arg.startswith("--"):
+            arg = arg[2:]
+        else:
+            continue
+        key, sep, value = arg.partition("=")
+        if sep:
+            settings[key.replace("-", "_")] = value
+    return settings
+
+
+def _async_database_url(url: str) -> Tuple[URL, Dict]:
+    """
+    Same database, asyncpg driver: postgresql://... -> postgresql+asyncpg://...
+    plus the connect_args for create_async_engine.
+
+    asyncpg.connect() rejects libpq-only query options, so the common ones are
+    translated (sslmode -> ssl, connect_timeout -> timeout, application_name and
+    options -> server_settings, sslrootcert/sslcert/sslkey -> an SSL context) and
+    any other is dropped with a warning.
+    """
+    for prefix in ("postgresql+psycopg2://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            url = "postgresql+asyncpg://" + url[len(prefix):]
+            break
+
+    parsed = make_url(url)
+    query = dict(parsed.query)
+    connect_args: Dict = {}
+    server_settings: Dict[str, str] = {}
+
+    sslmode = query.pop("sslmode", None)
+    if sslmode is not None:
+        if sslmode not in _SSLMODES:
+            raise RuntimeError(f"Unsupported sslmode in database URL: {sslmode!r}")
+        query.setdefault("ssl", sslmode)
+
+    if "connect_timeout" in query:
+        connect_args["timeout"] = float(query.pop("connect_timeout"))
+    if "options" in query:
+        server_settings.update(_libpq_options(query.pop("options")))
+    if "application_name" in query:
+        server_settings["application_name"] = query.pop("application_name")
+    if server_settings:
+        connect_args["server_settings"] = server_settings
+
+    rootcert = query.pop("sslrootcert", None)
+    cert = query.pop("sslcert", None)
+    key = query.pop("sslkey", None)
+    if rootcert or cert:
+        mode = query.get("ssl", "prefer")
+        if mode in ("require", "verify-ca", "verify-full"):
+            ctx = ssl.create_default_context(cafile=rootcert)
+            # As in libpq, a root cert without verify-full checks the CA only
+            ctx.check_hostname = mode == "verify-full"
+            if cert:
+                ctx.load_cert_chain(cert, key)
+            connect_args["ssl"] = ctx
+            del query["ssl"]
+        else:
+            print(f"[database] sslmode={mode}: ignoring sslrootcert/sslcert for asyncpg")
+
+    for name in sorted(set(query) - _ASYNCPG_URL_ARGS):
+        print(f"[database] Ignoring URL option {name!r}: not supported by asyncpg")
+        del query[name]
+
+    return parsed.set(query=query), connect_args
+
+
+# Async driver URL for the /check hot path (override with ASYNC_DATABASE_URL)
+ASYNC_DATABASE_URL, _ASYNC_CONNECT_ARGS = _async_database_url(
+    os.getenv("ASYNC_DATABASE_URL") or DATABASE_URL
+)
+
 # SQLAlchemy setup
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+# Pool sizes are env-tunable; recycle connections before Render's idle timeout kills them.
+_POOL_OPTIONS = dict(
+    pool_pre_ping=True,
+    pool_size=int(os.getenv("DB_POOL_SIZE", "20")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+    pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    pool_timeout=30,
+)
+
+# Sync engine: admin endpoints, cron scan and table creation
+engine = create_engine(DATABASE_URL, **_POOL_OPTIONS)
+# expire_on_commit=False: objects stay loaded after commit() (no re-SELECT on access)
+SessionLocal = sessionmaker(
+    bind=engine,
+    autocommit=False,
+    autoflush=False,
+    expire_on_commit=False,
+)
+
+# Async engine: /check, so waiting on Postgres never blocks the event loop
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL, connect_args=_ASYNC_CONNECT_ARGS, **_POOL_OPTIONS
+)
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine,
+    autoflush=False,
+    expire_on_commit=False,
+)
 
 Base = declarative_base()
 
 
 class License(Base):
     __tablename__ = "licenses"
+    __table_args__ = (
+        # Cron scan: active = true AND expires_at <= cutoff
+        Index("ix_licenses_active_expires", "active", "expires_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    code = Column(String(14), unique=True, index=True, nullable=False)  # XXXX-XXXX-XXXX
+    code = Column(String(14), unique=True, nullable=False)  # XXXX-XXXX-XXXX (unique index)
     email = Column(String(255), nullable=False)
     created_at = Column(DateTime(timezone=True), nullable=False)
     expires_at = Column(DateTime(timezone=True), nullable=False)
@@ -53,6 +199,8 @@ class LicenseDevice(Base):
     __tablename__ = "license_devices"
     __table_args__ = (
         UniqueConstraint("license_id", "machine_id", name="uq_license_machine"),
+        # Per-license device enumeration / count
+        Index("ix_devices_license_lastseen", "license_id", "last_seen"),
     )
 
     id = Column(Integer, primary_key=True, index=True)
@@ -64,17 +212,13 @@ class LicenseDevice(Base):
     license = relationship("License", back_populates="devices")
 
 
-ALPHABET = string.ascii_uppercase + string.digits
-
-
 def generate_license_code() -> str:
     """
-    Generate a code like XXXX-XXXX-XXXX using A–Z and 0–9.
+    Generate a code like XXXX-XXXX-XXXX using A–Z and 2–7 (base32).
+    One CSPRNG read per code (60 random bits) instead of one per character.
     """
-    def block() -> str:
-        return "".join(secrets.choice(ALPHABET) for _ in range(4))
-
-    return f"{block()}-{block()}-{block()}"
+    raw = base64.b32encode(secrets.token_bytes(9)).decode("ascii")
+    return f"{raw[0:4]}-{raw[4:8]}-{raw[8:12]}"
 
 
 def init_db() -> None:
@@ -91,27 +235,69 @@ def create_license(db: Session, email: str) -> License:
     now = datetime.now(timezone.utc)
     expires_at = now + timedelta(days=365)
 
-    # Try a few times in case of a very rare collision
+    # Insert directly and let the unique index on `code` detect the
+    # (very rare) collision, instead of probing with a SELECT first.
     for _ in range(10):
-        code = generate_license_code()
-        existing = db.query(License).filter(License.code == code).first()
-        if existing is None:
-            break
-    else:
-        raise RuntimeError("Could not generate a unique license code")
-
-    lic = License(
-        code=code,
-        email=email,
-        created_at=now,
-        expires_at=expires_at,
-        active=True,
+        lic = License(
+            code=generate_license_code(),
+            email=email,
+            created_at=now,
+            expires_at=expires_at,
+            active=True,
+        )
+        db.add(lic)
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            continue
+        return lic
+
+    raise RuntimeError("Could not generate a unique license code")
+
+
+async def register_device(
+    db: AsyncSession,
+    license_id: int,
+    machine_id: str,
+    now: datetime,
+    max_devices: int,
+) -> bool:
+    """
+    Register or refresh a device for a license in a single round-trip:
+      - known machine -> update last_seen
+      - new machine   -> insert, but only while the license has < max_devices
+
+    Returns False when the device limit prevented the insert.
+    """
+    known = exists().where(
+        LicenseDevice.license_id == license_id,
+        LicenseDevice.machine_id == machine_id,
     )
+    device_count = (
+        select(func.count())
+        .select_from(LicenseDevice)
+        .where(LicenseDevice.license_id == license_id)
+        .scalar_subquery()
+    )
+    row = select(
+        literal(license_id, Integer),
+        literal(machine_id, String),
+        literal(now, DateTime(timezone=True)),
+        literal(now, DateTime(timezone=True)),
+    ).where(or_(known, device_count < max_devices))
+
+    stmt = pg_insert(LicenseDevice).from_select(
+        ["license_id", "machine_id", "first_seen", "last_seen"], row
+    )
+    stmt = stmt.on_conflict_do_update(
+        constraint="uq_license_machine",
+        set_={"last_seen": stmt.excluded.last_seen},
+    ).returning(LicenseDevice.id)
 
-    db.add(lic)
-    db.commit()
-    db.refresh(lic)
-    return lic
+    registered = (await db.execute(stmt)).first() is not None
+    await db.commit()
+    return registered
 
 
 # ----------------------------------------------------------------------
@@ -121,8 +307,58 @@ def create_license(db: Session, email: str) -> License:
 # Make / webhook URL for license events (expires_soon / expired)
 LICENSE_WEBHOOK_URL = os.getenv("LICENSE_WEBHOOK_URL")
 
+# Parallel POSTs per scan; each worker thread keeps its own keep-alive connection
+WEBHOOK_WORKERS = 8
+# Licenses fetched per keyset page (and held in memory) per webhook batch
+WEBHOOK_BATCH = 500
+
+
+class _KeepAliveConnections:
+    """
+    Keep-alive connections, one per thread and webhook host. Each WebhookClient
+    owns its own set, so closing one client never touches another's sockets.
+    """
 
-def _post_json(url: str, payload: Dict) -> None:
+    def __init__(self) -> None:
+        self._local = threading.local()
+        # Every connection opened by any thread, so close() can close them all
+        self._opened: List[http.client.HTTPConnection] = []
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> Tuple[http.client.HTTPConnection, str]:
+        """
+        Return this thread's keep-alive connection to the URL's host, plus the
+        request path. Reusing it skips the TCP+TLS handshake on every POST.
+        """
+        parts = urlsplit(url)
+        conns = getattr(self._local, "conns", None)
+        if conns is None:
+            conns = self._local.conns = {}
+
+        key = (parts.scheme, parts.netloc)
+        conn = conns.get(key)
+        if conn is None:
+            if parts.scheme == "https":
+                conn = http.client.HTTPSConnection(parts.netloc, timeout=10)
+            else:
+                conn = http.client.HTTPConnection(parts.netloc, timeout=10)
+            conns[key] = conn
+            with self._lock:
+                self._opened.append(conn)
+
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        return conn, path
+
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._opened:
+                conn.close()
+            self._opened.clear()
+
+
+def _post_json(url: str, payload: Dict, conns: _KeepAliveConnections) -> None:
     """
     Small helper to POST JSON without adding new dependencies.
     This is intentionally 'best effort': errors are just printed.
@@ -131,23 +367,40 @@ def _post_json(url: str, payload: Dict) -> None:
         return
 
     data = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(
-        url,
-        data=data,
-        headers={"Content-Type": "application/json"},
-        method="POST",
-    )
-    try:
-        with urllib.request.urlopen(req, timeout=10) as resp:
-            # We do not need the body; just ensure the request succeeds.
+    for _ in range(2):
+        conn, path = conns.get(url)
+        reused = conn.sock is not None
+        try:
+            conn.request(
+                "POST",
+                path,
+                body=data,
+                headers={"Content-Type": "application/json"},
+            )
+            resp = conn.getresponse()
+            # We do not need the body, but it must be drained to reuse the socket.
             _ = resp.read()
-    except urllib.error.URLError as exc:
-        print(f"[license-webhook] Failed to POST to {url}: {exc}")
+        except (http.client.HTTPException, OSError) as exc:
+            conn.close()
+            if reused and isinstance(
+                exc, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+            ):
+                # The server dropped an idle keep-alive socket: reconnect once.
+                continue
+            print(f"[license-webhook] Failed to POST to {url}: {exc}")
+            return
+
+        if resp.status >= 400:
+            print(f"[license-webhook] Failed to POST to {url}: HTTP {resp.status}")
+        return
 
 
-def notify_license_to_webhook(lic: License, event: str) -> None:
+def notify_license_to_webhook(
+    lic: License, event: str, client: Optional["WebhookClient"] = None
+) -> None:
     """
-    Send a license-event notification to Make via LICENSE_WEBHOOK_URL.
+    Send a license-event notification to Make via LICENSE_WEBHOOK_URL, over
+    `client`'s connections (or a one-off connection when none is given).
 
     The payload shape is:
       {
@@ -167,20 +420,99 @@ def notify_license_to_webhook(lic: License, event: str) -> None:
         "code": lic.code,
         "expires_at": lic.expires_at.isoformat() if lic.expires_at else None,
     }
-    _post_json(LICENSE_WEBHOOK_URL, payload)
+    if client is not None:
+        client.post(payload)
+        return
+
+    conns = _KeepAliveConnections()
+    try:
+        _post_json(LICENSE_WEBHOOK_URL, payload, conns)
+    finally:
+        conns.close()
+
+
+class WebhookClient:
+    """
+    Long-lived webhook sender: WEBHOOK_WORKERS threads that each keep their
+    connection to the webhook host open between cron runs.
+    server.py creates one at startup (app.state.webhook) and closes it on shutdown.
+    """
+
+    def __init__(self, workers: int = WEBHOOK_WORKERS) -> None:
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="license-webhook"
+        )
+        self._conns = _KeepAliveConnections()
+
+    def post(self, payload: Dict) -> None:
+        """POST one JSON payload to LICENSE_WEBHOOK_URL over this client's connections."""
+        _post_json(LICENSE_WEBHOOK_URL, payload, self._conns)
+
+    def send_all(self, events: Iterable[Tuple[License, str]]) -> int:
+        """
+        Send (license, event) notifications concurrently, WEBHOOK_BATCH at a time,
+        so a streamed query is never fully materialised.
+
+        Returns the number of events consumed (sent or, without a webhook URL, skipped).
+        """
+        events = iter(events)
+        seen = 0
+
+        while True:
+            batch = list(islice(events, WEBHOOK_BATCH))
+            if not batch:
+                break
+            seen += len(batch)
+            if LICENSE_WEBHOOK_URL:
+                list(self._pool.map(lambda e: notify_license_to_webhook(*e, self), batch))
+
+        return seen
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
+        self._conns.close()
+
+
+def notify_licenses_to_webhook(
+    events: Iterable[Tuple[License, str]],
+    client: Optional[WebhookClient] = None,
+) -> int:
+    """
+    Send a batch of (license, event) notifications through `client`, or a
+    short-lived WebhookClient when none is given. Returns the event count.
+    """
+    if client is not None:
+        return client.send_all(events)
+
+    client = WebhookClient()
+    try:
+        return client.send_all(events)
+    finally:
+        client.close()
 
 
-def scan_licenses_and_notify(db: Session, now: datetime) -> Dict[str, int]:
+def scan_licenses_and_notify(
+    db: Session, now: datetime, webhook: Optional[WebhookClient] = None
+) -> Dict[str, int]:
     """
     Scan the database for licenses that are:
       - active AND already expired  -> mark inactive + send 'expired'
       - active AND exactly 7 days before expiration -> send 'expires_soon'
 
-    This is called from the cron endpoint in server.py.
+    This is called from the cron endpoint in server.py, which passes the
+    app-wide WebhookClient as `webhook`; without one, a client is created
+    for this scan only (shared by all of its webhook batches).
 
     Returns a dict with counters, e.g.:
       { "expires_soon": 3, "expired": 7 }
     """
+    if webhook is None:
+        webhook = WebhookClient()
+        try:
+            return scan_licenses_and_notify(db, now, webhook)
+        finally:
+            webhook.close()
+
     # Normalise 'now' to UTC (aware) and derive today's UTC date
     if now.tzinfo is None:
         now = now.replace(tzinfo=timezone.utc)
@@ -189,41 +521,62 @@ def scan_licenses_and_notify(db: Session, now: datetime) -> Dict[str, int]:
 
     today_utc = now.date()
     seven_days_later = today_utc + timedelta(days=7)
-    cutoff = datetime.combine(
+    soon_start = datetime.combine(
         seven_days_later, datetime.min.time(), tzinfo=timezone.utc
-    ) + timedelta(days=1)
-
-    # We only care about licenses that are still marked as active
-    # and that expire within the next 7 days (including already expired).
-    candidates = (
-        db.query(License)
-        .filter(
-            License.active.is_(True),
-            License.expires_at <= cutoff,
+    )
+    soon_end = soon_start + timedelta(days=1)
+
+    # Already expired: mark inactive and fetch the rows in one UPDATE ... RETURNING
+    expired = (
+        db.execute(
+            update(License)
+            .where(
+                License.active.is_(True),
+                License.expires_at <= now,
+            )
+            .values(active=False)
+            .returning(License)
         )
+        .scalars()
         .all()
     )
 
-    expires_soon_count = 0
-    expired_count = 0
-
-    for lic in candidates:
-        exp = lic.expires_at.astimezone(timezone.utc)
-
-        if exp <= now:
-            # Already expired: mark inactive and notify 'expired'
-            lic.active = False
-            notify_license_to_webhook(lic, event="expired")
-            expired_count += 1
-        else:
-            # Not yet expired but within <= 7 days.
-            # Only send the reminder exactly 7 days before the expiry date.
-            if exp.date() == seven_days_later:
-                notify_license_to_webhook(lic, event="expires_soon")
-                expires_soon_count += 1
+    # Commit before the network burst so a slow webhook never holds the transaction open
+    db.commit()
+    expired_count = notify_licenses_to_webhook(
+        ((lic, "expired") for lic in expired), webhook
+    )
 
-    if expires_soon_count or expired_count:
+    # Expiring exactly 7 days from today (UTC). A range on expires_at rather
+    # than date(expires_at) so the (active, expires_at) index can be used.
+    # Keyset-paged WEBHOOK_BATCH rows at a time: each page's read transaction
+    # ends before its webhooks go out, so no cursor is held open during POSTs.
+    page = (
+        select(License)
+        .where(
+            License.active.is_(True),
+            License.expires_at >= soon_start,
+            License.expires_at < soon_end,
+        )
+        .order_by(License.expires_at, License.id)
+        .limit(WEBHOOK_BATCH)
+    )
+    expires_soon_count = 0
+    after: Optional[Tuple[datetime, int]] = None
+    while True:
+        stmt = page if after is None else page.where(
+            tuple_(License.expires_at, License.id) > tuple_(*after)
+        )
+        batch = db.execute(stmt).scalars().all()
         db.commit()
+        if not batch:
+            break
+        expires_soon_count += notify_licenses_to_webhook(
+            ((lic, "expires_soon") for lic in batch), webhook
+        )
+        if len(batch) < WEBHOOK_BATCH:
+            break
+        after = (batch[-1].expires_at, batch[-1].id)
 
     return {
         "expires_soon": expires_soon_count,
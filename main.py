@@ -1,10 +1,8 @@
 # main.py
 import os
 import sys
-import shutil
-import site
-import pathlib
-from importlib.machinery import SourceFileLoader
+
+from tokens import parse_tokens, read_raw_tokens
 
 SERVER_URL    = os.getenv("MAYA_SERVER_URL", "https://maya-verification.onrender.com")
 APP_VERSION   = "1.0.0"
@@ -12,24 +10,31 @@ LICENSE_TOKEN = os.getenv("MAYA_LICENSE_TOKEN", "WORKSHOP_2025")
 MAYA_FILE     = "MAYA_12-10-25.py"  # keep your original filename
 
 # ---------- Runtime bootstrap so MAYA can use `-m pip` inside a PyInstaller binary ----------
-# Create a per-user site dir where pip can install without admin rights
-RUNTIME_DIR = os.path.join(pathlib.Path.home(), ".maya_runtime", "site")
-os.makedirs(RUNTIME_DIR, exist_ok=True)
+# Per-user site dir where pip can install without admin rights
+RUNTIME_DIR = os.path.join(os.path.expanduser("~"), ".maya_runtime", "site")
+
+def _bootstrap_runtime_dir():
+    """Prepare RUNTIME_DIR for MAYA's pip installs. Called from main() once the
+    license check has passed, so a refused launch never pays for it."""
+    import shutil
+    import site
 
-# Make sure Python searches this directory for imports (now and after restart)
-site.addsitedir(RUNTIME_DIR)
-if RUNTIME_DIR not in sys.path:
-    sys.path.insert(0, RUNTIME_DIR)
+    os.makedirs(RUNTIME_DIR, exist_ok=True)
 
-# Tell pip to install into RUNTIME_DIR when MAYA runs `-m pip install ...`
-os.environ["PIP_TARGET"] = RUNTIME_DIR
-os.environ.setdefault("PIP_DISABLE_PIP_VERSION_CHECK", "1")
+    # Make sure Python searches this directory for imports (now and after restart)
+    site.addsitedir(RUNTIME_DIR)
+    if RUNTIME_DIR not in sys.path:
+        sys.path.insert(0, RUNTIME_DIR)
 
-# Point sys.executable to a real Python interpreter, so `-m pip` works from MAYA
-_real_py = shutil.which("python3") or shutil.which("python")
-if _real_py:
-    sys.executable = _real_py
-# If no system Python is available, MAYA's own pip calls will fail on that machine.
+    # Tell pip to install into RUNTIME_DIR when MAYA runs `-m pip install ...`
+    os.environ["PIP_TARGET"] = RUNTIME_DIR
+    os.environ.setdefault("PIP_DISABLE_PIP_VERSION_CHECK", "1")
+
+    # Point sys.executable to a real Python interpreter, so `-m pip` works from MAYA
+    real_py = shutil.which("python3") or shutil.which("python")
+    if real_py:
+        sys.executable = real_py
+    # If no system Python is available, MAYA's own pip calls will fail on that machine.
 
 # (Optional) Allow fast/slow verification modes without rebuild (FAST|BALANCED|RENDER_FRIENDLY)
 os.environ.setdefault("MAYA_VERIFY_MODE", "FAST")
@@ -44,8 +49,15 @@ def resource_path(rel_path: str) -> str:
     return os.path.join(base, rel_path)
 
 def run_maya():
+    import importlib.util
+
+    # Spec-based load (load_module() is deprecated); exec_module goes through
+    # get_code(), which reuses a valid __pycache__ .pyc instead of recompiling.
     path = resource_path(MAYA_FILE)
-    maya_module = SourceFileLoader("maya_app", path).load_module()
+    spec = importlib.util.spec_from_file_location("maya_app", path)
+    maya_module = importlib.util.module_from_spec(spec)
+    sys.modules["maya_app"] = maya_module
+    spec.loader.exec_module(maya_module)
     if hasattr(maya_module, "main") and callable(maya_module.main):
         maya_module.main()
     else:
@@ -66,22 +78,17 @@ def _maybe_override_license_token_from_allowed_list():
     if os.getenv("MAYA_LICENSE_TOKEN"):
         return
 
-    tokens_file = os.getenv("TOKENS_FILE")  # e.g., /etc/secrets/tokens.txt
-    raw = ""
+    # TOKENS_FILE (e.g. /etc/secrets/tokens.txt) or ALLOWED_TOKENS; the file read
+    # is shared with config.load_allowed_tokens when both run in one process.
     try:
-        if tokens_file and os.path.exists(tokens_file):
-            with open(tokens_file, "r", encoding="utf-8") as f:
-                raw = f.read()
-        else:
-            raw = os.getenv("ALLOWED_TOKENS", "")
+        raw = read_raw_tokens()
     except Exception:
         # Silent fallback; keep default LICENSE_TOKEN.
         raw = ""
 
     # Split on common separators: newline, comma, semicolon, tabs, spaces
     try:
-        import re
-        parts = [p.strip() for p in re.split(r"[,\n;\r\t ]+", raw) if p.strip()]
+        parts = parse_tokens(raw)
         if parts:
             LICENSE_TOKEN = parts[0]  # first valid token
     except Exception:
@@ -95,6 +102,7 @@ _maybe_override_license_token_from_allowed_list()
 def main():
     from verifier import require_permission_or_exit
     require_permission_or_exit(SERVER_URL, LICENSE_TOKEN, APP_VERSION)
+    _bootstrap_runtime_dir()
     run_maya()
 
 if __name__ == "__main__":
@@ -1,29 +1,78 @@
 # server.py
-# Start Command: uvicorn server:app --host 0.0.0.0 --port $PORT
+# Start Command: WEB_CONCURRENCY=${WEB_CONCURRENCY:-2} uvicorn server:app --host 0.0.0.0 --port $PORT --loop uvloop --http httptools
+# (uvicorn takes its worker count from WEB_CONCURRENCY when --workers is not given)
+import hmac
 import os
+import sys
+import threading
 import time
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
-from typing import Optional
-
-from fastapi import FastAPI, Request, Depends, HTTPException
-from pydantic import BaseModel
+from typing import Annotated, FrozenSet, Optional, Tuple
+
+import orjson
+from fastapi import FastAPI, Depends, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, StringConstraints
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from config import ALLOWED_TOKENS
 from licenses_db import (
+    AsyncSessionLocal,
     SessionLocal,
+    async_engine,
     init_db,
     License,
     LicenseDevice,
+    WebhookClient,
     create_license,
+    register_device,
     scan_licenses_and_notify,  # NEW: cron helper for expiry notifications
 )
 
-app = FastAPI(title="māyā Verification — licensing + devices")
+app = FastAPI(
+    title="māyā Verification — licensing + devices",
+    default_response_class=ORJSONResponse,
+)
 
 # Maximum number of devices per license
 MAX_DEVICES = 2
 
+# Admin key for the protected endpoints (bytes, for hmac.compare_digest)
+_ADMIN_API_KEY = (os.getenv("ADMIN_API_KEY") or "").encode()
+
+# MAYA_DEBUG=1 echoes the request and env settings back in every /check response
+DEBUG = os.getenv("MAYA_DEBUG") == "1"
+
+# Every possible /check outcome: (allow, reason, ttl_seconds)
+Decision = Tuple[bool, str, int]
+
+_KILL_SWITCH_ON: Decision = (False, "Temporarily disabled by admin.", 30)
+_MACHINE_BLOCKED: Decision = (False, "Machine blocked. Please contact the māyā team.", 3600)
+_UPDATE_REQUIRED: Decision = (False, "Update required.", 3600)
+_MISSING_TOKEN: Decision = (False, "Missing token.", 3600)
+_INVALID_TOKEN: Decision = (
+    False,
+    "Invalid token. Please check your license key or contact the māyā team.",
+    3600,
+)
+_LICENSE_EXPIRED: Decision = (False, "License expired. Please renew your license key.", 3600)
+_MISSING_MACHINE_ID: Decision = (
+    False,
+    "Missing machine_id. Please contact the māyā team.",
+    3600,
+)
+_DEVICE_LIMIT: Decision = (
+    False,
+    "This license is already in use on the maximum number of devices (2). "
+    "If you changed computer, please contact the māyā team at mayahep.team@gmail.com.",
+    3600,
+)
+_EXPIRES_SOON: Decision = (True, "LICENSE_EXPIRES_SOON", 60)
+_ALLOWED: Decision = (True, "OK", 60)
+
 
 # ----------------------------------------------------------------------
 # Database dependency and startup
@@ -31,6 +80,17 @@ MAX_DEVICES = 2
 @app.on_event("startup")
 def on_startup() -> None:
     init_db()
+    # Shared by every cron run so webhook connections stay warm
+    app.state.webhook = WebhookClient()
+
+
+@app.on_event("shutdown")
+async def on_shutdown() -> None:
+    await async_engine.dispose()
+    # Missing if startup failed before creating it (e.g. init_db() raised)
+    webhook = getattr(app.state, "webhook", None)
+    if webhook is not None:
+        webhook.close()
 
 
 def get_db():
@@ -41,6 +101,11 @@ def get_db():
         db.close()
 
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
 # ----------------------------------------------------------------------
 # Pydantic models
 # ----------------------------------------------------------------------
@@ -51,7 +116,7 @@ class IssueRequest(BaseModel):
 
 class IssueResponse(BaseModel):
     code: str
-    expires_at: str
+    expires_at: datetime
 
 
 class RenewRequest(BaseModel):
@@ -61,8 +126,8 @@ class RenewRequest(BaseModel):
 
 class RenewResponse(BaseModel):
     code: str
-    old_expires_at: str
-    new_expires_at: str
+    old_expires_at: datetime
+    new_expires_at: datetime
 
 
 class ResetDevicesRequest(BaseModel):
@@ -74,21 +139,162 @@ class CronCheckRequest(BaseModel):  # NEW: body model for cron endpoint
     admin_key: str
 
 
+# Launcher-supplied string: stripped, and capped like license_devices.machine_id
+CheckField = Annotated[str, StringConstraints(strip_whitespace=True, max_length=128)]
+
+
+class CheckRequest(BaseModel):
+    token: CheckField = ""
+    machine_id: CheckField = ""
+    version: CheckField = ""
+
+
 # ----------------------------------------------------------------------
 # Utility: admin check
 # ----------------------------------------------------------------------
 def require_admin_key(key_from_request: str) -> None:
-    admin_key_env = os.getenv("ADMIN_API_KEY") or ""
-    if (not admin_key_env) or (key_from_request != admin_key_env):
+    # Constant-time compare: response timing must not leak how much of the key matched
+    if (not _ADMIN_API_KEY) or (
+        not hmac.compare_digest(_ADMIN_API_KEY, key_from_request.encode())
+    ):
         raise HTTPException(status_code=403, detail="Forbidden")
 
 
+# ----------------------------------------------------------------------
+# Utility: env settings (parsed once at startup into the globals below)
+# ----------------------------------------------------------------------
+def _env_set(name: str) -> FrozenSet[str]:
+    """Comma-separated env var -> frozenset of non-empty, stripped, interned items."""
+    raw = os.getenv(name, "")
+    return frozenset(sys.intern(x) for x in (p.strip() for p in raw.split(",")) if x)
+
+
+def _env_str(name: str) -> str:
+    return (os.getenv(name) or "").strip()
+
+
+# /check policy settings; env changes only take effect after a redeploy
+APP_VERSION = ""
+KILL_SWITCH = False
+BLOCKED_MACHINES: FrozenSet[str] = frozenset()
+# False when no blocklist, required version or static tokens are configured:
+# /check then goes straight to the license lookup
+STATIC_POLICY = False
+
+
+def _load_env_settings() -> None:
+    global APP_VERSION, KILL_SWITCH, BLOCKED_MACHINES, STATIC_POLICY
+    APP_VERSION = _env_str("APP_VERSION")
+    KILL_SWITCH = _env_str("KILL_SWITCH") == "1"
+    BLOCKED_MACHINES = _env_set("BLOCKED_MACHINES")
+    STATIC_POLICY = bool(APP_VERSION or BLOCKED_MACHINES or ALLOWED_TOKENS)
+
+
+_load_env_settings()
+
+
+# ----------------------------------------------------------------------
+# Utility: /check response builder
+# ----------------------------------------------------------------------
+def _decision(
+    allow: bool, reason: str, ttl_seconds: int, debug: Optional[dict] = None
+) -> dict:
+    resp = {"allow": allow, "reason": reason, "ttl_seconds": ttl_seconds}
+    if debug is not None:
+        resp["debug"] = debug
+    return resp
+
+
+# JSON bodies for every outcome, serialized once at import time
+_DECISION_BODIES = {
+    d: orjson.dumps(_decision(*d))
+    for d in (
+        _KILL_SWITCH_ON,
+        _MACHINE_BLOCKED,
+        _UPDATE_REQUIRED,
+        _MISSING_TOKEN,
+        _INVALID_TOKEN,
+        _LICENSE_EXPIRED,
+        _MISSING_MACHINE_ID,
+        _DEVICE_LIMIT,
+        _EXPIRES_SOON,
+        _ALLOWED,
+    )
+}
+
+
+def _reply(decision: Decision, debug: Optional[dict] = None) -> Response:
+    """
+    /check response. Without debug the prebuilt bytes are sent as-is, skipping
+    FastAPI's encoder; a fresh Response wraps them because FastAPI mutates it.
+    """
+    if debug is None:
+        return Response(_DECISION_BODIES[decision], media_type="application/json")
+    return ORJSONResponse(_decision(*decision, debug))
+
+
+# ----------------------------------------------------------------------
+# Utility: (token, machine_id) -> decision cache for the database path
+# ----------------------------------------------------------------------
+# Launchers re-check every ttl_seconds; answering repeats from memory skips
+# the DB round-trips. Entries live DECISION_CACHE_TTL seconds (LRU-capped)
+# and are dropped by /renew, /reset_devices and the cron scan. The cache is
+# per worker process, so only allow decisions are kept: a denial that an
+# admin call lifts (renew, device reset) must not linger in another worker.
+DECISION_CACHE_TTL = 30.0
+DECISION_CACHE_MAX = 10_000
+
+_decision_cache: "OrderedDict[Tuple[str, str], Tuple[float, Decision]]" = OrderedDict()
+# Admin endpoints run in the threadpool, so a thread lock (not asyncio.Lock)
+_decision_lock = threading.Lock()
+
+
+def _cached_decision(key: Tuple[str, str]) -> Optional[Decision]:
+    with _decision_lock:
+        hit = _decision_cache.get(key)
+        if hit is None:
+            return None
+        until, decision = hit
+        if time.monotonic() >= until:
+            del _decision_cache[key]
+            return None
+        _decision_cache.move_to_end(key)
+        return decision
+
+
+def _remember_decision(key: Tuple[str, str], decision: Decision) -> None:
+    with _decision_lock:
+        _decision_cache[key] = (time.monotonic() + DECISION_CACHE_TTL, decision)
+        _decision_cache.move_to_end(key)
+        if len(_decision_cache) > DECISION_CACHE_MAX:
+            _decision_cache.popitem(last=False)
+
+
+def _forget_decisions(code: Optional[str] = None) -> None:
+    """Drop cached decisions for one license code (or all of them)."""
+    with _decision_lock:
+        if code is None:
+            _decision_cache.clear()
+            return
+        for key in [k for k in _decision_cache if k[0] == code]:
+            del _decision_cache[key]
+
+
 # ----------------------------------------------------------------------
 # Health endpoint (Render uses this too)
 # ----------------------------------------------------------------------
+# (second, JSON body) of the last /health reply; rebuilt at most once per second
+_health_cache: Tuple[int, bytes] = (0, b"")
+
+
 @app.get("/health")
-def health():
-    return {"ok": True, "ts": int(time.time())}
+async def health():
+    # async def: runs on the event loop, no threadpool hop for Render's polling
+    global _health_cache
+    ts = time.time_ns() // 1_000_000_000
+    if ts != _health_cache[0]:
+        _health_cache = (ts, orjson.dumps({"ok": True, "ts": ts}))
+    return Response(_health_cache[1], media_type="application/json")
 
 
 # ----------------------------------------------------------------------
@@ -106,7 +312,7 @@ def issue_license(payload: IssueRequest, db: Session = Depends(get_db)):
 
     return IssueResponse(
         code=lic.code,
-        expires_at=lic.expires_at.isoformat(),
+        expires_at=lic.expires_at,
     )
 
 
@@ -135,22 +341,20 @@ def renew_license(payload: RenewRequest, db: Session = Depends(get_db)):
     lic.expires_at = new_expires
     lic.active = True
 
-    # Reset devices on renewal
-    devices = (
+    # Reset devices on renewal (single DELETE, no rows loaded)
+    (
         db.query(LicenseDevice)
         .filter(LicenseDevice.license_id == lic.id)
-        .all()
+        .delete(synchronize_session=False)
     )
-    removed = len(devices)
-    for dev in devices:
-        db.delete(dev)
 
     db.commit()
+    _forget_decisions(lic.code)
 
     return RenewResponse(
         code=lic.code,
-        old_expires_at=old_expires.isoformat(),
-        new_expires_at=new_expires.isoformat(),
+        old_expires_at=old_expires,
+        new_expires_at=new_expires,
     )
 
 
@@ -171,16 +375,14 @@ def reset_devices(payload: ResetDevicesRequest, db: Session = Depends(get_db)):
     if not lic:
         raise HTTPException(status_code=404, detail="License not found")
 
-    devices = (
+    # Single DELETE; its rowcount is the number of devices removed
+    removed = (
         db.query(LicenseDevice)
         .filter(LicenseDevice.license_id == lic.id)
-        .all()
+        .delete(synchronize_session=False)
     )
-
-    removed = len(devices)
-    for dev in devices:
-        db.delete(dev)
     db.commit()
+    _forget_decisions(lic.code)
 
     return {
         "ok": True,
@@ -193,7 +395,9 @@ def reset_devices(payload: ResetDevicesRequest, db: Session = Depends(get_db)):
 # NEW: cron endpoint for license expiry notifications (Make webhook)
 # ----------------------------------------------------------------------
 @app.post("/cron/check_licenses")
-def cron_check_licenses(payload: CronCheckRequest, db: Session = Depends(get_db)):
+def cron_check_licenses(
+    payload: CronCheckRequest, request: Request, db: Session = Depends(get_db)
+):
     """
     Cron entry point (called once per day from Render or another scheduler).
 
@@ -207,7 +411,9 @@ def cron_check_licenses(payload: CronCheckRequest, db: Session = Depends(get_db)
     require_admin_key(payload.admin_key)
 
     now = datetime.now(timezone.utc)
-    counts = scan_licenses_and_notify(db, now)
+    counts = scan_licenses_and_notify(db, now, request.app.state.webhook)
+    if counts["expired"]:
+        _forget_decisions()
 
     return {
         "ok": True,
@@ -220,7 +426,7 @@ def cron_check_licenses(payload: CronCheckRequest, db: Session = Depends(get_db)
 # Main /check endpoint used by the māyā launcher
 # ----------------------------------------------------------------------
 @app.post("/check")
-async def check(request: Request, db: Session = Depends(get_db)):
+async def check(req: CheckRequest, db: AsyncSession = Depends(get_async_db)):
     """
     Main entry point called by the māyā launcher.
 
@@ -234,186 +440,110 @@ async def check(request: Request, db: Session = Depends(get_db)):
       - rejects extra machines beyond MAX_DEVICES
       - soon-to-expire warning flag (<= 7 days)
     """
-    try:
-        data = await request.json()
-    except Exception as e:
-        return {
-            "allow": False,
-            "reason": f"BAD_JSON: {e}",
-            "ttl_seconds": 5,
-        }
-
-    token = str(data.get("token", "")).strip()
-    machine_id = str(data.get("machine_id", "")).strip()
-    version = str(data.get("version", "")).strip()
-
-    app_version = (os.getenv("APP_VERSION") or "").strip()
-    kill_switch = (os.getenv("KILL_SWITCH") or "0").strip()
-
-    raw_blocked = (os.getenv("BLOCKED_MACHINES") or "").split(",")
-    blocked = [m.strip() for m in raw_blocked if m.strip()]
-
-    debug = {
-        "received": data,
-        "env": {
-            "APP_VERSION": app_version,
-            "KILL_SWITCH": kill_switch,
-            "BLOCKED_MACHINES": blocked,
-        },
-    }
-
     # ------------------------------------------------------------------
     # 0) Global kill switch
     # ------------------------------------------------------------------
-    if kill_switch == "1":
-        return {
-            "allow": False,
-            "reason": "Temporarily disabled by admin.",
-            "ttl_seconds": 30,
-            "debug": debug,
-        }
-
-    # ------------------------------------------------------------------
-    # 1) Per-machine blocking
-    # ------------------------------------------------------------------
-    if machine_id and (machine_id in blocked):
-        return {
-            "allow": False,
-            "reason": "Machine blocked. Please contact the māyā team.",
-            "ttl_seconds": 3600,
-            "debug": debug,
+    if KILL_SWITCH:
+        return _reply(_KILL_SWITCH_ON)
+
+    token = req.token
+    machine_id = req.machine_id
+    version = req.version
+
+    app_version = APP_VERSION
+    blocked = BLOCKED_MACHINES
+    allowed = ALLOWED_TOKENS
+
+    debug = None
+    if DEBUG:
+        debug = {
+            "received": req.model_dump(),
+            "env": {
+                "APP_VERSION": app_version,
+                "BLOCKED_MACHINES": sorted(blocked),
+            },
         }
 
-    # ------------------------------------------------------------------
-    # 2) Required version
-    # ------------------------------------------------------------------
-    if app_version and version and (version != app_version):
-        return {
-            "allow": False,
-            "reason": "Update required.",
-            "ttl_seconds": 3600,
-            "debug": debug,
-        }
-
-    # ------------------------------------------------------------------
-    # 3) Static workshop tokens (no DB, no device limit)
-    # ------------------------------------------------------------------
-    if token and (token in ALLOWED_TOKENS):
-        return {
-            "allow": True,
-            "reason": "OK",
-            "ttl_seconds": 60,
-            "debug": debug,
-        }
+    if STATIC_POLICY:
+        # --------------------------------------------------------------
+        # 1) Per-machine blocking
+        # --------------------------------------------------------------
+        if machine_id and (machine_id in blocked):
+            return _reply(_MACHINE_BLOCKED, debug)
+
+        # --------------------------------------------------------------
+        # 2) Required version
+        # --------------------------------------------------------------
+        if app_version and version and (version != app_version):
+            return _reply(_UPDATE_REQUIRED, debug)
+
+        # --------------------------------------------------------------
+        # 3) Static workshop tokens (no DB, no device limit)
+        # --------------------------------------------------------------
+        if token and (token in allowed):
+            return _reply(_ALLOWED, debug)
 
     # ------------------------------------------------------------------
     # 4) Dynamic licenses stored in PostgreSQL
     # ------------------------------------------------------------------
     if not token:
-        return {
-            "allow": False,
-            "reason": "Missing token.",
-            "ttl_seconds": 3600,
-            "debug": debug,
-        }
+        return _reply(_MISSING_TOKEN, debug)
+
+    key = (token, machine_id)
+    if debug is None:
+        cached = _cached_decision(key)
+        if cached is not None:
+            return _reply(cached)
 
+    decision = await _check_license(db, token, machine_id, debug)
+    if debug is None and decision[0]:
+        _remember_decision(key, decision)
+    return _reply(decision, debug)
+
+
+async def _check_license(
+    db: AsyncSession, token: str, machine_id: str, debug: Optional[dict]
+) -> Decision:
+    """
+    /check steps 4-6: license validity, device registration, expiry warning.
+    """
     now = datetime.now(timezone.utc)
 
-    lic: Optional[License] = db.query(License).filter(License.code == token).first()
+    result = await db.execute(select(License).where(License.code == token))
+    lic: Optional[License] = result.scalar_one_or_none()
     if not lic:
-        return {
-            "allow": False,
-            "reason": "Invalid token. Please check your license key or contact the māyā team.",
-            "ttl_seconds": 3600,
-            "debug": debug,
-        }
+        return _INVALID_TOKEN
 
     if (not lic.active) or (now >= lic.expires_at):
         if lic.active:
             lic.active = False
-            db.commit()
-        return {
-            "allow": False,
-            "reason": "License expired. Please renew your license key.",
-            "ttl_seconds": 3600,
-            "debug": debug,
-        }
+            await db.commit()
+        return _LICENSE_EXPIRED
 
     # ------------------------------------------------------------------
     # 5) Automatic device registration (max 2 devices)
     # ------------------------------------------------------------------
     if not machine_id:
-        return {
-            "allow": False,
-            "reason": "Missing machine_id. Please contact the māyā team.",
-            "ttl_seconds": 3600,
-            "debug": debug,
-        }
-
-    device: Optional[LicenseDevice] = (
-        db.query(LicenseDevice)
-        .filter(
-            LicenseDevice.license_id == lic.id,
-            LicenseDevice.machine_id == machine_id,
-        )
-        .first()
-    )
+        return _MISSING_MACHINE_ID
 
-    if device:
-        # Known machine: just update last_seen
-        device.last_seen = now
-        db.commit()
-    else:
-        # New machine: check how many devices are already registered
-        current_devices = (
-            db.query(LicenseDevice)
-            .filter(LicenseDevice.license_id == lic.id)
-            .count()
-        )
-
-        if current_devices >= MAX_DEVICES:
-            return {
-                "allow": False,
-                "reason": (
-                    "This license is already in use on the maximum number of devices (2). "
-                    "If you changed computer, please contact the māyā team at mayahep.team@gmail.com."
-                ),
-                "ttl_seconds": 3600,
-                "debug": debug,
-            }
-
-        # Register this new device
-        new_dev = LicenseDevice(
-            license_id=lic.id,
-            machine_id=machine_id,
-            first_seen=now,
-            last_seen=now,
-        )
-        db.add(new_dev)
-        db.commit()
+    # Known machine -> last_seen is refreshed; new machine -> registered if
+    # the license still has a free slot. One SQL statement either way.
+    if not await register_device(db, lic.id, machine_id, now, MAX_DEVICES):
+        return _DEVICE_LIMIT
 
     # ------------------------------------------------------------------
     # 6) Expiry warning (<= 7 days)
     # ------------------------------------------------------------------
     days_left = (lic.expires_at - now).days
-    debug["license"] = {
-        "email": lic.email,
-        "expires_at": lic.expires_at.isoformat(),
-        "days_left": days_left,
-    }
+    if debug is not None:
+        debug["license"] = {
+            "email": lic.email,
+            "expires_at": lic.expires_at.isoformat(),
+            "days_left": days_left,
+        }
 
     if days_left <= 7:
-        return {
-            "allow": True,
-            "reason": "LICENSE_EXPIRES_SOON",
-            "ttl_seconds": 60,
-            "debug": debug,
-        }
+        return _EXPIRES_SOON
 
     # All checks passed
-    return {
-        "allow": True,
-        "reason": "OK",
-        "ttl_seconds": 60,
-        "debug": debug,
-    }
+    return _ALLOWED
@@ -0,0 +1,34 @@
+# tokens.py
+import functools
+import os
+import re
+from typing import List
+
+# Separators accepted between tokens: commas, semicolons and any whitespace
+_TOKEN_SPLIT_RE = re.compile(r"[,\n;\r\t ]+")
+
+
+def parse_tokens(raw: str) -> List[str]:
+    """
+    Split raw token text into non-empty, stripped tokens (original order kept).
+    """
+    return [p for p in (x.strip() for x in _TOKEN_SPLIT_RE.split(raw)) if p]
+
+
+@functools.lru_cache(maxsize=1)
+def _read_tokens_file(path: str, mtime_ns: int) -> str:
+    # mtime_ns only takes part in the cache key, so an edited file is re-read
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def read_raw_tokens() -> str:
+    """
+    Raw token text from a Secret File if provided (TOKENS_FILE=/etc/secrets/tokens.txt),
+    otherwise from the ALLOWED_TOKENS env var.
+    The file is read once per process unless it changes on disk.
+    """
+    tokens_file = os.getenv("TOKENS_FILE")
+    if tokens_file and os.path.exists(tokens_file):
+        return _read_tokens_file(tokens_file, os.stat(tokens_file).st_mtime_ns)
+    return os.getenv("ALLOWED_TOKENS", "")
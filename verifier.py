@@ -1,11 +1,32 @@
 # verifier.py — fast-fail version with total deadline
-import json, time, uuid, hashlib, getpass, platform, os
-from typing import Tuple
-import requests, certifi
+import json, time, uuid, hashlib, getpass, platform, os, sys, functools, ssl, threading, random
+from typing import Optional, Tuple
+import httpx, certifi
+
+try:
+    import tkinter as tk
+    from tkinter import messagebox
+except ImportError:  # headless Python build: fall back to stderr
+    tk = None
+
+try:
+    from orjson import dumps as _json_dumps, loads as _json_loads  # faster when available
+except ImportError:
+    from json import loads as _json_loads
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+try:
+    import h2  # noqa: F401  (enables httpx's HTTP/2 support)
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
 
 # ---------- MODES (pick one) ----------
-# FAST: fails in ~4–6s if no network/server
-FAST = dict(CONNECT=2, READ=3, WARMUP_TRIES=1, CHECK_TRIES=1, BACKOFF=0.4, TOTAL_DEADLINE=6)
+# FAST: fails in ~4–6s if no network/server. No separate warm-up: the first /check
+# doubles as the wake-up ping and a second (jittered) attempt covers a cold server.
+FAST = dict(CONNECT=2, READ=3, WARMUP_TRIES=0, CHECK_TRIES=2, BACKOFF=0.4, TOTAL_DEADLINE=6)
 # BALANCED: a bit more patient (~10–12s)
 BALANCED = dict(CONNECT=3, READ=5, WARMUP_TRIES=2, CHECK_TRIES=2, BACKOFF=0.8, TOTAL_DEADLINE=12)
 # RENDER_FRIENDLY: tolerates cold starts (~18–22s)
@@ -22,15 +43,74 @@ CHECK_TRIES       = CFG["CHECK_TRIES"]
 BACKOFF           = CFG["BACKOFF"]
 TOTAL_DEADLINE    = CFG["TOTAL_DEADLINE"]
 
+# Machine-ID digest. "sha256" (default) keeps the IDs already registered on the
+# server; "blake2b" is faster and half as long, but every machine gets a new ID
+# (and counts against MAX_DEVICES again), so only switch on a fresh rollout.
+MACHINE_ID_HASH = os.getenv("MAYA_MACHINE_ID_HASH", "sha256").lower()
+
 
 def _deadline_remaining(start: float) -> float:
     return max(0.0, TOTAL_DEADLINE - (time.monotonic() - start))
 
 
+def _mac_platform_uuid() -> str:
+    """
+    IOPlatformUUID read straight from IOKit through ctypes (no `ioreg` fork+exec).
+    Returns "" if the registry has no such property.
+    """
+    import ctypes
+    import ctypes.util
+
+    iokit = ctypes.CDLL(ctypes.util.find_library("IOKit"))
+    cf = ctypes.CDLL(ctypes.util.find_library("CoreFoundation"))
+    utf8 = 0x08000100  # kCFStringEncodingUTF8
+
+    iokit.IOServiceMatching.restype = ctypes.c_void_p
+    iokit.IOServiceMatching.argtypes = [ctypes.c_char_p]
+    iokit.IOServiceGetMatchingService.restype = ctypes.c_uint32
+    iokit.IOServiceGetMatchingService.argtypes = [ctypes.c_uint32, ctypes.c_void_p]
+    iokit.IORegistryEntryCreateCFProperty.restype = ctypes.c_void_p
+    iokit.IORegistryEntryCreateCFProperty.argtypes = [
+        ctypes.c_uint32, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint32
+    ]
+    iokit.IOObjectRelease.argtypes = [ctypes.c_uint32]
+    cf.CFStringCreateWithCString.restype = ctypes.c_void_p
+    cf.CFStringCreateWithCString.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_uint32]
+    cf.CFStringGetCString.restype = ctypes.c_bool
+    cf.CFStringGetCString.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_long, ctypes.c_uint32]
+    cf.CFRelease.argtypes = [ctypes.c_void_p]
+
+    # kIOMasterPortDefault is 0; the matching dict is consumed by the call
+    service = iokit.IOServiceGetMatchingService(
+        0, iokit.IOServiceMatching(b"IOPlatformExpertDevice")
+    )
+    if not service:
+        return ""
+    try:
+        key = cf.CFStringCreateWithCString(None, b"IOPlatformUUID", utf8)
+        try:
+            prop = iokit.IORegistryEntryCreateCFProperty(service, key, None, 0)
+        finally:
+            cf.CFRelease(key)
+        if not prop:
+            return ""
+        try:
+            buf = ctypes.create_string_buffer(128)
+            if not cf.CFStringGetCString(prop, buf, len(buf), utf8):
+                return ""
+            return buf.value.decode("utf-8")
+        finally:
+            cf.CFRelease(prop)
+    finally:
+        iokit.IOObjectRelease(service)
+
+
+@functools.lru_cache(maxsize=1)
 def build_machine_id() -> str:
     """
     Build a stable machine identifier that does not change
-    across normal updates.
+    across normal updates. Computed once per process (memoized):
+    no repeated registry reads, file reads or `ioreg` subprocesses.
 
     Priority:
       - Windows: MachineGuid
@@ -79,23 +159,32 @@ def build_machine_id() -> str:
     # macOS-specific identifier
     # -------------------------------
     elif os_name == "darwin":
+        uuid_str = ""
         try:
-            import subprocess
+            uuid_str = _mac_platform_uuid()
+        except Exception:
+            pass
 
-            out = subprocess.check_output(
-                ["ioreg", "-rd1", "-c", "IOPlatformExpertDevice"],
-                stderr=subprocess.DEVNULL,
-                text=True,
-            )
-            for line in out.splitlines():
-                if "IOPlatformUUID" in line:
+        # Fallback: parse `ioreg` output (same value, one subprocess)
+        if not uuid_str:
+            try:
+                import subprocess
+
+                out = subprocess.check_output(
+                    ["ioreg", "-rd1", "-c", "IOPlatformExpertDevice"],
+                    stderr=subprocess.DEVNULL,
+                    text=True,
+                )
+                _, sep, tail = out.partition("IOPlatformUUID")
+                if sep:
                     # line example: "  \"IOPlatformUUID\" = \"XXXX-XXXX-...\""
+                    line = tail.split("\n", 1)[0]
                     uuid_str = line.split("=")[-1].strip().strip('"')
-                    if uuid_str:
-                        parts.append(f"MACUUID:{uuid_str}")
-                        break
-        except Exception:
-            pass
+            except Exception:
+                pass
+
+        if uuid_str:
+            parts.append(f"MACUUID:{uuid_str}")
 
     # -------------------------------
     # Fallback: persistent local ID in ~/.maya_runtime/machine_id
@@ -125,102 +214,172 @@ def build_machine_id() -> str:
             parts.append(f"FALLBACK:{uuid.uuid4().hex}")
 
     raw = "|".join(parts).encode("utf-8", "ignore")
+    if MACHINE_ID_HASH == "blake2b":
+        return hashlib.blake2b(raw, digest_size=16).hexdigest()
     return hashlib.sha256(raw).hexdigest()
 
 
-def _session() -> requests.Session:
-    s = requests.Session()
-    s.verify = certifi.where()
-    # No automatic retries: we control timing ourselves
-    return s
-
-
-def _warmup(base_url: str, start: float) -> None:
-    """Ping /health a few times to 'wake' the server. Doesn't block if the deadline runs out."""
-    url = base_url.rstrip("/") + "/health"
-    sess = _session()
+# One keep-alive client for warmup and /check: the check reuses the warmup's
+# TCP+TLS connection (multiplexed over HTTP/2 when h2 is installed).
+# httpx never retries on its own: we control timing ourselves.
+_CLIENT = httpx.Client(
+    http2=_HTTP2,
+    verify=ssl.create_default_context(cafile=certifi.where()),
+    timeout=httpx.Timeout(
+        connect=CONNECT_TIMEOUT, read=READ_TIMEOUT, write=READ_TIMEOUT, pool=READ_TIMEOUT
+    ),
+    limits=httpx.Limits(
+        max_connections=4, max_keepalive_connections=4, keepalive_expiry=85.0
+    ),
+    headers={"User-Agent": "maya-verifier/1.0"},
+)
+
+
+def _call_timeout(start: float) -> Optional[httpx.Timeout]:
+    """Per-call timeouts clamped to the remaining deadline; None if there's no time left
+    for a request to finish."""
+    rem = _deadline_remaining(start)
+    if rem <= 0.1:
+        return None
+    ct = min(CONNECT_TIMEOUT, rem)
+    rt = min(READ_TIMEOUT, max(0.1, rem))
+    return httpx.Timeout(connect=ct, read=rt, write=rt, pool=ct)
+
+
+@functools.lru_cache(maxsize=4)
+def _resolve_urls(server_url: str) -> Tuple[str, str]:
+    """(health_url, check_url) for a server base URL, built once per server."""
+    base = server_url.rstrip("/")
+    return base + "/health", base + "/check"
+
+
+def _warmup(url: str, start: float, stop: Optional[threading.Event] = None) -> None:
+    """Ping /health a few times to 'wake' the server. Doesn't block if the deadline runs out.
+    Setting `stop` (e.g. once /check has answered) ends the retries early."""
+    stop = stop or threading.Event()
     for i in range(WARMUP_TRIES):
-        if _deadline_remaining(start) <= 0:
+        timeout = _call_timeout(start)
+        if timeout is None or stop.is_set():
             return
         try:
-            sess.get(url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            _CLIENT.get(url, timeout=timeout)
             return  # with a 200 or even 404 we know it responded
         except Exception:
-            # short backoff, still respecting the deadline
-            sleep_s = min(BACKOFF * (2 ** i), _deadline_remaining(start))
+            # short full-jitter backoff, still respecting the deadline
+            cap = BACKOFF * (2 ** i)
+            sleep_s = min(random.uniform(0, cap), _deadline_remaining(start))
             if sleep_s > 0:
-                time.sleep(sleep_s)
+                stop.wait(sleep_s)
+
+
+def _start_warmup(url: str, start: float, stop: threading.Event) -> threading.Thread:
+    """
+    Run _warmup in a background thread so the first /check doesn't wait for it.
+    Daemon: exiting the launcher (e.g. SystemExit on a denial) never waits for it.
+    """
+    thread = threading.Thread(
+        target=_warmup, args=(url, start, stop), name="maya-warmup", daemon=True
+    )
+    thread.start()
+    return thread
+
 
+_JSON_HEADERS = {"Content-Type": "application/json"}
 
-def _post_check(base_url: str, payload: dict, start: float) -> Tuple[bool, str, int]:
-    url = base_url.rstrip("/") + "/check"
-    sess = _session()
+
+def _post_check(url: str, body: bytes, start: float) -> Tuple[bool, str, int, bool]:
+    """
+    One /check attempt: (allow, reason, ttl_seconds, retryable).
+    Only network errors and 5xx (e.g. a server still starting) are worth retrying;
+    a decision the server actually returned is final.
+    """
+    timeout = _call_timeout(start)
+    if timeout is None:
+        return (False, f"Timed out after ~{TOTAL_DEADLINE}s", 5, False)
     try:
-        r = sess.post(url, json=payload, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        r = _CLIENT.post(url, content=body, headers=_JSON_HEADERS, timeout=timeout)
     except Exception as e:
-        return (False, f"Network error: {e}", 5)
+        return (False, f"Network error: {e}", 5, True)
 
     if r.status_code != 200:
-        return (False, f"Server error: {r.status_code}", 5)
+        return (False, f"Server error: {r.status_code}", 5, r.status_code >= 500)
 
     try:
-        data = r.json()
-    except json.JSONDecodeError:
-        return (False, "Bad JSON from server.", 5)
+        data = _json_loads(r.content)
+    except json.JSONDecodeError:  # orjson.JSONDecodeError subclasses it
+        return (False, "Bad JSON from server.", 5, False)
 
     allow = bool(data.get("allow"))
     reason = str(data.get("reason", ""))
     ttl = int(data.get("ttl_seconds", 5))
-    return (allow, reason, ttl)
+    return (allow, reason, ttl, False)
 
 
 def check_online(server_url: str, token: str, version: str) -> Tuple[bool, str, int]:
     start = time.monotonic()
     payload = {"token": token, "machine_id": build_machine_id(), "version": version}
+    body = _json_dumps(payload)  # serialized once, reused by every attempt
+    health_url, check_url = _resolve_urls(server_url)
 
-    # 1) Very short warm-up (or none, depending on mode)
-    _warmup(server_url, start)
+    # 1) Very short warm-up (or none, depending on mode), running alongside
+    #    the first /check so the two network waits overlap
+    stop_warmup = threading.Event()
+    warmup = _start_warmup(health_url, start, stop_warmup) if WARMUP_TRIES > 0 else None
 
-    # 2) /check attempts until we hit the deadline
-    last_reason, last_ttl = "Timeout", 5
-    for i in range(CHECK_TRIES):
-        if _deadline_remaining(start) <= 0:
-            break
-        ok, reason, ttl = _post_check(server_url, payload, start)
-        if ok:
-            return ok, reason, ttl
-        last_reason, last_ttl = reason, ttl
-        sleep_s = min(BACKOFF * (2 ** i), _deadline_remaining(start))
-        if sleep_s > 0:
-            time.sleep(sleep_s)
-
-    # 3) If the deadline is exceeded, fail fast with a clear message
-    if _deadline_remaining(start) <= 0:
-        return False, f"Timed out after ~{TOTAL_DEADLINE}s", 5
-    return False, last_reason, last_ttl
+    try:
+        # 2) /check attempts until we hit the deadline
+        last_reason, last_ttl = "Timeout", 5
+        for i in range(CHECK_TRIES):
+            if _deadline_remaining(start) <= 0:
+                break
+            ok, reason, ttl, retryable = _post_check(check_url, body, start)
+            if ok or not retryable:
+                return ok, reason, ttl
+            last_reason, last_ttl = reason, ttl
+            if i == CHECK_TRIES - 1:
+                break  # no backoff after the last attempt
+            if i == 0 and warmup is not None:
+                # First attempt failed: let the warm-up finish waking the server
+                warmup.join(timeout=_deadline_remaining(start))
+            cap = BACKOFF * (2 ** i)
+            sleep_s = min(random.uniform(0, cap), _deadline_remaining(start))
+            if sleep_s > 0:
+                time.sleep(sleep_s)
 
+        # 3) If the deadline is exceeded, fail fast with a clear message
+        if _deadline_remaining(start) <= 0:
+            return False, f"Timed out after ~{TOTAL_DEADLINE}s", 5
+        return False, last_reason, last_ttl
+    finally:
+        stop_warmup.set()
 
-def require_permission_or_exit(server_url: str, token: str, version: str) -> None:
-    import tkinter as tk
-    from tkinter import messagebox
 
+def _show_message(kind: str, message: str) -> None:
+    """Show a māyā dialog ("showerror"/"showwarning"); Tk is only started here."""
+    if tk is None:
+        print(f"māyā: {message}", file=sys.stderr)
+        return
     root = tk.Tk()
     root.withdraw()
+    try:
+        getattr(messagebox, kind)("māyā", message)
+    finally:
+        root.destroy()
 
+
+def require_permission_or_exit(server_url: str, token: str, version: str) -> None:
     allowed, reason, _ = check_online(server_url, token, version)
 
     if allowed:
         # License valid; if it is close to expiry, warn the user.
         if reason == "LICENSE_EXPIRES_SOON":
-            messagebox.showwarning(
-                "māyā",
+            _show_message(
+                "showwarning",
                 "Your license will expire in less than 7 days.\n"
                 "Please renew your license key.",
             )
-        root.destroy()
         return
 
     # Not allowed: show error and exit
-    messagebox.showerror("māyā", f"No permission: {reason}")
-    root.destroy()
+    _show_message("showerror", f"No permission: {reason}")
     raise SystemExit(1)